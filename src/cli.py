@@ -2,7 +2,7 @@ import sys
 import argparse
 
 __all__ = [
-    "MAC_ADDRESS", "CLIENT", "TICK", "SHUTDOWN_DELAY", "PING_COUNT"
+    "MAC_ADDRESS", "CLIENT", "TICK", "SHUTDOWN_DELAY", "PING_COUNT", "SUSPEND"
 ]
 
 parser = argparse.ArgumentParser(
@@ -23,7 +23,10 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    "-t", "--tick", help="Seconds to wait before checking for a state change.", type=float, default=10
+    "-t", "--tick", help="Seconds to wait before checking for a state change. While proxmox is up on mains power this "
+                         "backs off to at most a minute (or an eighth of the shutdown delay), power changes are "
+                         "still picked up immediately on Linux.",
+    type=float, default=10
 )
 
 parser.add_argument(
@@ -32,10 +35,16 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    "-p", "--ping-count", help="Number of pings to send to determine whether client is alive or not.", type=int,
+    "-p", "--ping-count", help="Number of probes to send to determine whether client is alive or not.", type=int,
     default=4,
 )
 
+parser.add_argument(
+    "--suspend", help="Suspend the laptop between Wake on LAN packets while waiting for proxmox to come back up, "
+                      "using the RTC alarm to wake up every tick. Requires root.",
+    action="store_true"
+)
+
 args = parser.parse_args(sys.argv[1:])
 
 MAC_ADDRESS = args.mac_address
@@ -43,3 +52,4 @@ CLIENT = args.client
 TICK = args.tick
 SHUTDOWN_DELAY = args.shutdown_delay
 PING_COUNT = args.ping_count
+SUSPEND = args.suspend
@@ -1,5 +1,11 @@
+import signal
+
 from cli import *
 from server import Server
 
 if __name__ == "__main__":
-    Server(MAC_ADDRESS, CLIENT, TICK, SHUTDOWN_DELAY, PING_COUNT).run()
+    server = Server(MAC_ADDRESS, CLIENT, TICK, SHUTDOWN_DELAY, PING_COUNT, SUSPEND)
+    # Let systemctl stop (and Ctrl+C) interrupt any pending wait instead of waiting for it to time out.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: server.stop())
+    server.run()
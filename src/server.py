@@ -1,77 +1,232 @@
+import logging
+import math
+import os
+import random
+import select
+import socket
 import subprocess
+from functools import lru_cache
 from os.path import expanduser
-from time import time, sleep
+from time import monotonic, time
 
 import psutil
 from fabric import Connection
+from invoke.exceptions import CommandTimedOut
 from sshconf import read_ssh_config
 from wakeonlan import send_magic_packet
-from paramiko.ssh_exception import SSHException, NoValidConnectionsError
+from paramiko.ssh_exception import AuthenticationException, BadHostKeyException, SSHException
+
+# Connection failures are expected while the client is booting or powered off, and are already handled by retrying.
+# Without a handler paramiko's transport thread would dump them to stderr through logging's last resort handler.
+logging.getLogger("paramiko").addHandler(logging.NullHandler())
+
+# Netlink protocol on which the kernel broadcasts uevents, including power supply changes (see linux/netlink.h).
+NETLINK_KOBJECT_UEVENT = 15
+RTC_WAKEALARM = "/sys/class/rtc/rtc0/wakealarm"
+
+# Misconfigured keys or hosts, retrying these won't help.
+PERMANENT_SSH_ERRORS = (AuthenticationException, BadHostKeyException)
+# Failures that go away on their own, e.g. while the client boots or the network flaps. OSError covers paramiko's
+# NoValidConnectionsError as well as timeouts, resets and unreachable hosts.
+TRANSIENT_SSH_ERRORS = (SSHException, CommandTimedOut, EOFError, OSError)
+
+
+@lru_cache(maxsize=1)
+def _ssh_config():
+    return read_ssh_config(expanduser("~/.ssh/config"))
 
 
 class Server:
+    # Bounds (in seconds) for the exponential backoff applied after a failed ssh attempt.
+    SSH_RETRY_BASE = 1
+    SSH_RETRY_CAP = 10
+    # Upper bound (in seconds) for the polling interval once the client has been up on mains power for a while. It is
+    # further limited to a fraction of the shutdown delay, so a missed power event can't eat up the battery window.
+    MAX_POLLING_INTERVAL = 60
+    SHUTDOWN_DELAY_POLLING_FRACTION = 1 / 8
+    # Largest number of doublings applied to a polling interval, any cap is reached well before this.
+    MAX_IDLE_CYCLES = 32
+    # Seconds for which a battery reading is reused instead of querying the power supply again.
+    BATTERY_CACHE_TTL = 0.5
+    # Seconds after which a stuck ssh connection or remote command is abandoned.
+    SSH_TIMEOUT = 10
+    # Seconds to stay suspended at least, and the least lead time the RTC alarm needs. Entering suspend takes a few
+    # seconds, an alarm that fires before the machine is asleep would leave it suspended with nothing to wake it up.
+    SUSPEND_MIN_INTERVAL = 30
+    SUSPEND_MIN_LEAD = 10
+
     def __init__(self, mac_address: str, client: str = "proxmox", tick: float = 10, shutdown_delay: float = 4,
-                 ping_count: int = 4):
+                 ping_count: int = 4, suspend: bool = False):
         """
         Main server class.
         :param client: an ssh alias defined in ~/.ssh/config
         :param mac_address: MAC address of the interface on which the Wake on LAN packet should be sent.
-        :param tick: Seconds to wait before checking for a state change.
+        :param tick: Seconds to wait before checking for a state change, backing off while nothing changes.
         :param shutdown_delay: Minutes to wait before shutting down the server, after detecting a power outage.
-        :param ping_count: Number of pings to perform while checking if host is alive.
+        :param ping_count: Number of probes to perform while checking if host is alive.
+        :param suspend: Suspend this machine between Wake on LAN packets, using the RTC alarm to wake up again.
         """
 
         self.client = client
-        self.ip = read_ssh_config(expanduser("~/.ssh/config")).host(client)["hostname"]
+        host = _ssh_config().host(client)
+        self.ip = host["hostname"]
+        self.port = int(host.get("port", 22))
         # See https://wiki.archlinux.org/title/Wake-on-LAN if you're having trouble with Wake on LAN.
         self.mac_address = mac_address
 
         self.tick = float(tick)
         self.shutdown_delay = float(shutdown_delay)
         self.ping_count = int(ping_count)
+        self.suspend = bool(suspend)
+        if self.suspend and not os.access(RTC_WAKEALARM, os.W_OK):
+            raise PermissionError(f"Suspending requires write access to {RTC_WAKEALARM}, try running as root.")
+        self.max_polling_interval = max(
+            self.tick, min(self.MAX_POLLING_INTERVAL, self.shutdown_delay * 60 * self.SHUTDOWN_DELAY_POLLING_FRACTION)
+        )
+
+        self._battery_cache = (float("-inf"), True)
+        # Set by stop(). Waits select() on the read end of the socketpair, which stop() writes to, so a signal handler
+        # can interrupt them without taking any locks.
+        self.stopped = False
+        self._stop_r, self._stop_w = socket.socketpair()
+        self._power_events = self.power_events()
 
     @property
     def client_is_alive(self) -> bool:
-        return subprocess.call(
-            ["ping", "-c", str(self.ping_count), str(self.ip)],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        ) == 0
+        # A TCP connect to sshd is cheaper than spawning ping, and returns on the first successful probe.
+        for _ in range(self.ping_count):
+            try:
+                with socket.create_connection((self.ip, self.port), timeout=1):
+                    return True
+            except ConnectionRefusedError:
+                return True  # the host answered, sshd just isn't listening while booting or shutting down.
+            except OSError:
+                continue
+        return False
 
     @property
     def power_state(self) -> bool:
+        timestamp, on_mains = self._battery_cache
+        now = monotonic()  # immune to the wall clock being stepped, e.g. by NTP after a resume
+        if now - timestamp < self.BATTERY_CACHE_TTL:
+            return on_mains
+
         battery = psutil.sensors_battery()
-        if battery is None:
-            # Returning True because if you're running this on a machine without a battery, you're probably testing and
-            # also if you think about it, on a desktop, battery status is always True ;)
-            return True
-        return battery.power_plugged
+        # Defaulting to True because if you're running this on a machine without a battery, you're probably testing and
+        # also if you think about it, on a desktop, battery status is always True ;)
+        on_mains = True if battery is None else battery.power_plugged
+        self._battery_cache = (now, on_mains)
+        return on_mains
 
     def execute_shutdown_cmd(self):
-        conn = Connection(self.client)
-        conn.run("systemctl poweroff", hide=True)
-        conn.close()
+        conn = Connection(self.client, connect_timeout=self.SSH_TIMEOUT)
+        try:
+            conn.run("systemctl poweroff", hide=True, timeout=self.SSH_TIMEOUT)
+        finally:
+            conn.close()
 
     def wakeup_client(self):
         send_magic_packet(self.mac_address)
 
+    def suspend_until(self, wakeup_time: float) -> bool:
+        """
+        Suspends this machine and returns once the RTC alarm has woken it up again, or stop() is called.
+        :return: False if the machine couldn't be suspended.
+        """
+        wakeup_time = math.ceil(wakeup_time)  # the alarm has a one second resolution, never round it closer
+        if wakeup_time - time() < self.SUSPEND_MIN_LEAD:
+            return False
+        try:
+            # The alarm has to be cleared before a new one can be set.
+            with open(RTC_WAKEALARM, "w") as alarm:
+                alarm.write("0")
+            with open(RTC_WAKEALARM, "w") as alarm:
+                alarm.write(str(wakeup_time))
+        except OSError:
+            return False
+        if subprocess.call(["systemctl", "suspend"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+            return False
+
+        # systemctl returns before the machine actually sleeps, and monotonic timeouts don't advance while suspended,
+        # so wait in short steps against the wall clock until the alarm time has passed.
+        while (remaining := wakeup_time - time()) > 0:
+            if self.sleep(min(remaining, 1)):
+                break
+        return True
+
+    @staticmethod
+    def poll_interval(idle_cycles: int, base: float, cap: float) -> float:
+        # Double the interval for every cycle in which nothing changed, with jitter to spread out wakeups.
+        return min(base * 2 ** idle_cycles * random.uniform(0.5, 1.5), cap)
+
+    @staticmethod
+    def power_events():
+        """
+        Returns a socket that becomes readable whenever the kernel reports a uevent, or None where that isn't supported.
+        """
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))  # group 1 carries the kernel's own uevents
+        except (AttributeError, OSError):
+            return None
+        return sock
+
+    def sleep(self, timeout: float) -> bool:
+        """
+        Blocks until stop() is called or the timeout expires.
+        :return: True if stop() was called.
+        """
+        select.select([self._stop_r], [], [], timeout)
+        return self.stopped
+
+    def wait(self, timeout: float, on_mains: bool) -> bool:
+        """
+        Blocks until the power state no longer matches on_mains, stop() is called or the timeout expires.
+        :param on_mains: The power state the caller last acted on.
+        :return: True if stop() was called.
+        """
+        if self._power_events is None:
+            return self.sleep(timeout)
+
+        deadline = monotonic() + timeout
+        while not self.stopped and (remaining := deadline - monotonic()) > 0:
+            ready, _, _ = select.select([self._power_events, self._stop_r], [], [], remaining)
+            if self._power_events not in ready:
+                continue
+            try:
+                uevent = self._power_events.recv(8192)
+            except OSError:
+                # ENOBUFS: the kernel dropped uevents, one of which may have been a power change.
+                uevent = b"SUBSYSTEM=power_supply"
+            if b"SUBSYSTEM=power_supply" in uevent:
+                self._battery_cache = (float("-inf"), True)  # the cached reading predates this event
+                # Events queued up during probes or a suspend are mostly stale, only a real change ends the wait.
+                if self.power_state != on_mains:
+                    break
+        return self.stopped
+
     def shutdown_client(self):
         shutdown_time = time() + self.shutdown_delay * 60
+        idle_cycles = 0
 
-        # Executing shutdown delay
-        while time() <= shutdown_time:
+        # Executing shutdown delay. Power supply events end the wait early, polling is kept in case one is missed.
+        while (remaining := shutdown_time - time()) >= 0:
             on_mains = self.power_state
             if on_mains:
                 return  # power is back, abort shutdown.
-            sleep(1)
+            cap = 10 if remaining > 60 else 1 if remaining < 10 else remaining / 6
+            if self.wait(min(self.poll_interval(idle_cycles, 1, cap), max(remaining, 0.1)), on_mains):
+                return
+            idle_cycles = min(idle_cycles + 1, self.MAX_IDLE_CYCLES)
 
         self.execute_shutdown_cmd()
 
         # Waiting for client to shut down, this makes wake up code simple.
         while self.client_is_alive:
-            sleep(1)
+            if self.sleep(1):
+                return
 
-    def main(self):
+    def main(self) -> tuple:
         client_alive = self.client_is_alive
         on_mains = self.power_state
 
@@ -80,13 +235,56 @@ class Server:
         elif not on_mains and client_alive:
             self.shutdown_client()
 
+        return on_mains, client_alive
+
+    def ssh_backoff(self, retry_count: int) -> float:
+        # Full jitter keeps multiple laptops from reconnecting in lockstep after a shared outage.
+        return random.uniform(0, min(self.SSH_RETRY_CAP, self.SSH_RETRY_BASE * 2 ** retry_count))
+
     def run(self):
-        while True:
+        try:
+            self._run()
+        finally:
+            self.close()
+
+    def _run(self):
+        retry_count = 0
+        idle_cycles = 0
+        last_state = None
+        while not self.stopped:
             try:
-                self.main()
-                sleep(self.tick)
-            except (SSHException, NoValidConnectionsError):
-                continue
+                state = self.main()
+                retry_count = 0
+                # Only back off while the client is up on mains, an outage or a client waiting for Wake on LAN needs a
+                # check every tick. Clamped so that a long stable stretch can't overflow the float conversion.
+                idle_cycles = min(idle_cycles + 1, self.MAX_IDLE_CYCLES) if state == last_state and all(state) else 0
+                last_state = state
+                interval = self.poll_interval(idle_cycles, self.tick, self.max_polling_interval)
+                on_mains, client_alive = state
+                if self.suspend and on_mains and not client_alive and \
+                        self.suspend_until(time() + max(interval, self.SUSPEND_MIN_INTERVAL)):
+                    continue  # slept through the interval, time to send the next Wake on LAN packet.
+                self.wait(interval, on_mains)
+            except PERMANENT_SSH_ERRORS:
+                raise  # retrying won't fix a misconfigured key or host, fail fast instead.
+            except TRANSIENT_SSH_ERRORS:
+                self.sleep(self.ssh_backoff(retry_count))
+                retry_count += 1
+
+    def stop(self):
+        # Wakes up any pending wait so that run() returns promptly. Only sets a flag and writes a byte, so it is safe to
+        # call from a signal handler.
+        if self.stopped:
+            return
+        self.stopped = True
+        os.write(self._stop_w.fileno(), b"\0")
+
+    def close(self):
+        self.stopped = True  # keeps a late stop() from writing to the closed socket
+        if self._power_events is not None:
+            self._power_events.close()
+        self._stop_r.close()
+        self._stop_w.close()
 
 
 if __name__ == "__main__":